@@ -1,9 +1,13 @@
-from PIL import Image, ImageDraw, ImageFont, ImageFilter
+import PIL
+from PIL import Image, ImageDraw, ImageFont, ImageFilter, ImageOps
 import requests
+from requests.adapters import HTTPAdapter
 from io import BytesIO
 import configparser
 import time
-import copy
+import functools
+import hashlib
+import concurrent.futures
 import os
 import urllib.parse # Import for URL encoding
 
@@ -11,6 +15,36 @@ import urllib.parse # Import for URL encoding
 def debug_print(message):
     print(f"DEBUG: {message}")
 
+# Raised inside cache_hits() so failed lookups never end up in the cache
+class _CacheMiss(Exception):
+    pass
+
+# Like functools.lru_cache, but a None result (failed lookup) is not cached,
+# so a network hiccup doesn't stick to a URL/track until it falls out of the cache
+def cache_hits(maxsize):
+    def decorator(func):
+        @functools.lru_cache(maxsize=maxsize)
+        def cached(*args):
+            result = func(*args)
+            if result is None:
+                raise _CacheMiss
+            return result
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            try:
+                return cached(*args)
+            except _CacheMiss:
+                return None
+
+        wrapper.cache_info = cached.cache_info
+        wrapper.cache_clear = cached.cache_clear
+        return wrapper
+    return decorator
+
+# Pillow-SIMD is a drop-in replacement and reports versions like "9.5.0.post1"
+debug_print(f"Pillow version: {PIL.__version__}{' (SIMD build)' if 'post' in PIL.__version__ else ''}")
+
 # Read the configuration file
 config = configparser.ConfigParser()
 config.read('dab-broadcast.conf')
@@ -27,17 +61,33 @@ LASTFM_API_KEY = config.get('dab-broadcast', 'lastfm_api_key', fallback='')
 # ---------------------------
 LOGO_FILE_PATH = 'logo.png' # Specified logo file
 
+# Shared HTTP session so the now-playing, Last.fm and album art requests reuse keep-alive connections
+SESSION = requests.Session()
+SESSION.headers.update({'User-Agent': 'dab-slideshow-v2'})
+http_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+SESSION.mount('http://', http_adapter)
+SESSION.mount('https://', http_adapter)
+
 # Define the target image size (REQUIRED: 320x240)
 TARGET_WIDTH = 320
 TARGET_HEIGHT = 240
 LOGO_BLOCK_SIZE = 55 # New uniform logo size (55x55)
 TEXT_BG_HEIGHT = 55
 TEXT_BG_Y = TARGET_HEIGHT - TEXT_BG_HEIGHT
+ALBUM_ART_THUMBNAIL_SIZE = 140
+BLUR_DOWNSCALE = 8 # Background blur: shrink by this factor, then scale back up
+ALBUM_ART_CACHE_SIZE = 64 # Station playlists loop, so keep recent art around
+BG_CACHE_SIZE = 16 # Composited backgrounds are full frames, so keep fewer of them
+
+# Function to get a font at a given size, reusing already parsed TrueType files
+@functools.lru_cache(maxsize=128)
+def _font(path, size):
+    return ImageFont.truetype(path, size)
 
 # --- INITIAL FONT CONFIGURATION ---
 INITIAL_FONT_SIZE = 20
 try:
-    base_font = ImageFont.truetype(title_font_path, INITIAL_FONT_SIZE)
+    base_font = _font(title_font_path, INITIAL_FONT_SIZE)
     # logo_font no longer needed as we are using an image
     debug_print("Fonts loaded successfully.")
 except Exception as e:
@@ -46,6 +96,13 @@ except Exception as e:
 
 # Initialize variables
 last_songname = ""
+last_etag = None # ETag of the last now-playing response, for conditional GETs
+last_response_hash = None # Hash of the last now-playing body, for servers without ETag
+last_output_hash = None # Hash of the last encoded output image
+BG_CACHE = {} # album_art_url -> composited background + thumbnail (320x240 RGBA, no text bar)
+
+# Returned by fetch_now_playing_with_retries() when the now-playing data hasn't changed
+NOW_PLAYING_UNCHANGED = object()
 
 # Function to load and resize the logo (Updated to 55x55)
 def load_logo(path, target_size=(LOGO_BLOCK_SIZE, LOGO_BLOCK_SIZE)):
@@ -58,7 +115,7 @@ def load_logo(path, target_size=(LOGO_BLOCK_SIZE, LOGO_BLOCK_SIZE)):
         if logo.mode != "RGBA":
             logo = logo.convert("RGBA")
 
-        logo = logo.resize(target_size, Image.LANCZOS)
+        logo = logo.resize(target_size, Image.BILINEAR)
         debug_print(f"Logo loaded and resized to {target_size}.")
         return logo
     except Exception as e:
@@ -76,6 +133,7 @@ except Exception as e:
 # ------------------------------------------------------------------------------------------------
 
 # --- NEW FUNCTION: Fetch album art URL from Last.fm ---
+@cache_hits(maxsize=ALBUM_ART_CACHE_SIZE)
 def fetch_lastfm_album_art_url(artistname, songname, api_key):
     if not artistname or not songname or not api_key:
         debug_print("Missing artist, song, or Last.fm API key.")
@@ -94,7 +152,7 @@ def fetch_lastfm_album_art_url(artistname, songname, api_key):
 
     try:
         debug_print(f"Last.fm lookup for: {artistname} - {songname}")
-        response = requests.get(LASTFM_API_URL, params=params, timeout=10)
+        response = SESSION.get(LASTFM_API_URL, params=params, timeout=10)
 
         if response.status_code == 200:
             data = response.json()
@@ -137,61 +195,87 @@ def fetch_lastfm_album_art_url(artistname, songname, api_key):
 # -------------------------------------------------------------------
 
 
+# Scratch canvas for text measurement (textbbox doesn't depend on the canvas size)
+MEASURE_DRAW = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+
+# Function to measure text, memoized since the same strings are measured repeatedly
+@functools.lru_cache(maxsize=512)
+def _measure(text, font_path, font_size):
+    return MEASURE_DRAW.textbbox((0, 0), text, font=_font(font_path, font_size))
+
 # Function to adjust font size based on the text length
 def adjust_font_size(text, font, max_width):
-    # This block is unchanged, kept for completeness
-    image = Image.new('RGBA', (max_width, 1))
-    draw = ImageDraw.Draw(image)
-    current_font = copy.copy(font)
-
     try:
-        bbox = draw.textbbox((0, 0), text, font=current_font)
+        bbox = _measure(text, font.path, font.size)
         width = bbox[2] - bbox[0]
     except Exception as e:
         debug_print(f"Initial font measurement error for '{text}': {e}. Returning initial size.")
-        return current_font
+        return font
 
-    while width > max_width and current_font.size > 1:
-        new_size = current_font.size - 1
-        current_font = ImageFont.truetype(current_font.path, new_size)
+    if width <= max_width:
+        return font
 
+    # Binary search for the largest size that fits (size 1 if nothing does)
+    low, high = 1, font.size - 1
+    best_size = 1
+    while low <= high:
+        size = (low + high) // 2
         try:
-            bbox = draw.textbbox((0, 0), text, font=current_font)
-            width = bbox[2] - bbox[0]
+            bbox = _measure(text, font.path, size)
+            fits = bbox[2] - bbox[0] <= max_width
         except Exception:
-            break
+            fits = False
+
+        if fits:
+            best_size = size
+            low = size + 1
+        else:
+            high = size - 1
 
-    return current_font
+    return _font(font.path, best_size)
 
 # Function to truncate the text with ellipsis if it's too long
 def truncate_text(text, font, max_width):
-    # This block is unchanged, kept for completeness
-    image = Image.new('RGBA', (max_width, 1))
-    draw = ImageDraw.Draw(image)
-
-    original_text = text
-    while draw.textbbox((0, 0), text, font=font)[2] > max_width and len(text) > 3:
-        text = text[:-4] + "..."
-
-        if len(text) <= 3 and len(original_text) > 3:
-            text = original_text[:3] + "..."
-            break
+    if len(text) <= 3 or _measure(text, font.path, font.size)[2] <= max_width:
+        return text
+
+    # Binary search for the longest prefix that fits with "..." appended,
+    # keeping at least 3 characters
+    low, high = 4, len(text) - 1
+    best_length = 3
+    while low <= high:
+        length = (low + high) // 2
+        if _measure(text[:length] + "...", font.path, font.size)[2] <= max_width:
+            best_length = length
+            low = length + 1
+        else:
+            high = length - 1
 
-    return text
+    return text[:best_length] + "..."
 
 # Function to fetch now playing data with retries
 def fetch_now_playing_with_retries(max_retries=3, retry_delay=5):
     global LASTFM_API_KEY # Use the global variable
+    global last_etag, last_response_hash
     for attempt in range(max_retries):
         try:
             now_playing_url = icecast_url if use_icecast else azuracast_url
             debug_print(f"Fetching data from: {now_playing_url}, Attempt: {attempt + 1}")
-            response = requests.get(now_playing_url, timeout=10)
+            headers = {'If-None-Match': last_etag} if last_etag else {}
+            response = SESSION.get(now_playing_url, headers=headers, timeout=10)
+
+            if response.status_code == 304:
+                return NOW_PLAYING_UNCHANGED
 
             if response.status_code != 200:
                 print(f"Error: Received response with status code {response.status_code}")
                 return None, None, None
 
+            # Servers without ETag support: compare the raw body before parsing it
+            response_hash = hashlib.blake2b(response.content, digest_size=8).digest()
+            if response_hash == last_response_hash:
+                return NOW_PLAYING_UNCHANGED
+
             try:
                 data = response.json()
                 debug_print("Data fetched successfully.")
@@ -223,6 +307,11 @@ def fetch_now_playing_with_retries(max_retries=3, retry_delay=5):
                 album_art_url = data.get("now_playing", {}).get("song", {}).get("art", None)
 
             debug_print(f"Now playing: {songname} by {artistname}")
+
+            # Only remember this response once it has been fully handled, so a failure
+            # above (bad JSON, Last.fm error) doesn't make the retry look "unchanged"
+            last_etag = response.headers.get('ETag')
+            last_response_hash = response_hash
             return songname, artistname, album_art_url
 
         except Exception as e:
@@ -241,9 +330,14 @@ def fetch_album_art(album_art_url):
              return None
 
         debug_print(f"Fetching album art from: {album_art_url}")
-        art_response = requests.get(album_art_url, timeout=10)
+        art_response = SESSION.get(album_art_url, timeout=10)
         if art_response.status_code == 200:
             album_art = Image.open(BytesIO(art_response.content))
+            # Let libjpeg decode at a reduced scale; we never need more than ~2x the output size
+            try:
+                album_art.draft('RGB', (TARGET_WIDTH * 2, TARGET_HEIGHT * 2))
+            except Exception as e:
+                debug_print(f"Album art draft decode not available: {e}")
             album_art = album_art.convert("RGBA")
             debug_print("Album art fetched successfully.")
             return album_art
@@ -254,99 +348,91 @@ def fetch_album_art(album_art_url):
         debug_print(f"Error fetching album art: {e}")
         return None
 
-# Main loop to keep updating the image
-while True:
-    try:
-        songname, artistname, album_art_url = fetch_now_playing_with_retries(max_retries=5, retry_delay=10)
+# Function to turn album art into the 320x240 background crop and the thumbnail
+def make_album_art_layers(album_art):
+    # ImageOps.fit resamples just the centered region with the output aspect ratio,
+    # in a single resize call, instead of resizing the whole image and cropping after
+    resized_art = ImageOps.fit(album_art, (TARGET_WIDTH, TARGET_HEIGHT), method=Image.BILINEAR, centering=(0.5, 0.5))
+
+    album_art_thumbnail = album_art.resize((ALBUM_ART_THUMBNAIL_SIZE, ALBUM_ART_THUMBNAIL_SIZE), Image.BICUBIC)
+    # Most album art is fully opaque; as RGB it can be pasted without an alpha mask
+    if album_art_thumbnail.getextrema()[3] == (255, 255):
+        album_art_thumbnail = album_art_thumbnail.convert("RGB")
+    return resized_art, album_art_thumbnail
+
+# Function to blur the background cheaply: the detail is thrown away anyway, so
+# shrinking to 1/8 and scaling back up looks like a wide Gaussian blur
+def blur_background(image):
+    small_size = (image.width // BLUR_DOWNSCALE, image.height // BLUR_DOWNSCALE)
+    small = image.resize(small_size, Image.BILINEAR)
+    small = small.filter(ImageFilter.BoxBlur(1)) # Smooth out the blockiness before upscaling
+    return small.resize(image.size, Image.BILINEAR)
+
+# Function to fetch album art and prepare its layers, memoized by URL
+@cache_hits(maxsize=ALBUM_ART_CACHE_SIZE)
+def fetch_album_art_layers(album_art_url):
+    album_art = fetch_album_art(album_art_url)
+    if album_art is None:
+        return None
+    return make_album_art_layers(album_art)
 
-        if songname and (songname != last_songname or not last_songname):
-            debug_print(f"Song has changed or is initial run: {last_songname} -> {songname}")
+# The fallback logo never changes, so prepare its layers once
+FALLBACK_ART_LAYERS = make_album_art_layers(FALLBACK_LOGO_FULL) if FALLBACK_LOGO_FULL is not None else None
 
-            # Create a blank image with the target dimensions (320x240)
-            output_image = Image.new("RGBA", (TARGET_WIDTH, TARGET_HEIGHT), (0, 0, 0, 255))
-            draw = ImageDraw.Draw(output_image)
-            
-            # --- Album Art and Fallback Logic ---
-            
-            # Attempt to fetch album art
-            album_art_full_res = None
-            if album_art_url:
-                album_art_full_res = fetch_album_art(album_art_url)
-
-            # Use fallback logo if album art is not found
-            if album_art_full_res is None and FALLBACK_LOGO_FULL is not None:
-                debug_print("Using fallback logo as album art.")
-                album_art_full_res = FALLBACK_LOGO_FULL
-            elif album_art_full_res is None:
-                debug_print("No album art and no fallback logo available.")
-
-            # --- Background: Blurred Album Art/Fallback Logo ---
-            if album_art_full_res:
-                img_ratio = album_art_full_res.width / album_art_full_res.height
-                output_ratio = TARGET_WIDTH / TARGET_HEIGHT
-
-                if img_ratio > output_ratio:
-                    new_height = TARGET_HEIGHT
-                    new_width = int(new_height * img_ratio)
-                    resized_art = album_art_full_res.resize((new_width, new_height), Image.LANCZOS)
-                    left = (new_width - TARGET_WIDTH) / 2
-                    resized_art = resized_art.crop((left, 0, left + TARGET_WIDTH, TARGET_HEIGHT))
-                else:
-                    new_width = TARGET_WIDTH
-                    new_height = int(new_width / img_ratio)
-                    resized_art = album_art_full_res.resize((new_width, new_height), Image.LANCZOS)
-                    top = (new_height - TARGET_HEIGHT) / 2
-                    resized_art = resized_art.crop((0, top, TARGET_WIDTH, top + TARGET_HEIGHT))
-
-                blurred_background = resized_art.filter(ImageFilter.GaussianBlur(radius=8))
-                output_image.paste(blurred_background, (0, 0))
-            else:
-                debug_print("Could not create blurred background (using black default).")
-
-            # --- Album Art Thumbnail and Border (Position based on text bar) ---
-            album_art_thumbnail_size = 140
-            border_size = 2
-
-            # Position calculations
-            available_top_space = TEXT_BG_Y - 0
-            thumb_x = (TARGET_WIDTH - album_art_thumbnail_size) // 2
-            thumb_y = (available_top_space - album_art_thumbnail_size) // 2
-
-            # Draw Border (a grey rectangle)
-            border_rect = (
-                thumb_x - border_size,
-                thumb_y - border_size,
-                thumb_x + album_art_thumbnail_size + border_size,
-                thumb_y + album_art_thumbnail_size + border_size
-            )
-            draw.rectangle(border_rect, fill=(55, 56, 52, 180))
-
-            if album_art_full_res: # Use the same image (either fetched or fallback) for the thumbnail
-                album_art_thumbnail = album_art_full_res.resize((album_art_thumbnail_size, album_art_thumbnail_size), Image.LANCZOS)
-                output_image.paste(album_art_thumbnail, (thumb_x, thumb_y), album_art_thumbnail)
-            else:
-                debug_print("Could not create album art thumbnail (only border visible).")
+# --- Static Overlay (dark bottom bar + logo), built once ---
+LOGO_IMG = load_logo(LOGO_FILE_PATH)
 
-            # --- Text Overlay and Logo Placement ---
+# Dark bottom bar; only this band has any opacity, so the layer covers just that
+BAR_LAYER = Image.new('RGBA', (TARGET_WIDTH, TEXT_BG_HEIGHT), (0, 0, 0, 180))
 
-            overlay = Image.new('RGBA', (TARGET_WIDTH, TARGET_HEIGHT), (0, 0, 0, 0))
-            overlay_draw = ImageDraw.Draw(overlay)
+# --- Paste External Logo (No pink background) ---
+if LOGO_IMG:
+    # Logo sits at the top-left of the bar, i.e. (0, TEXT_BG_Y) in the final image
+    BAR_LAYER.paste(LOGO_IMG, (0, 0), LOGO_IMG)
+# ------------------------------------------------------------------------------------------------
 
-            # Draw the dark bottom bar
-            overlay_draw.rectangle([(0, TEXT_BG_Y), (TARGET_WIDTH, TARGET_HEIGHT)], fill=(0, 0, 0, 180))
+# Function to save the output image, skipping the write if the encoded bytes are unchanged
+def save_output_image(image, path):
+    global last_output_hash
+    image_format = 'JPEG' if path.lower().endswith(('.jpg', '.jpeg')) else 'PNG'
+    buffer = BytesIO()
+    image.save(buffer, format=image_format)
 
-            # --- Load and Paste External Logo (No pink background) ---
-            logo_img = load_logo(LOGO_FILE_PATH)
-            if logo_img:
-                # Logo position is (0, TEXT_BG_Y) which is the top-left of the logo block area
-                logo_x = 0
-                logo_y = TEXT_BG_Y
-                # Paste the logo directly onto the dark bottom bar
-                overlay.paste(logo_img, (logo_x, logo_y), logo_img)
+    output_hash = hashlib.blake2b(buffer.getvalue()).digest()
+    if output_hash == last_output_hash:
+        return False
 
+    # Write to a temp file and rename, so readers never see a half-written image
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(buffer.getvalue())
+    os.replace(temp_path, path)
+    last_output_hash = output_hash
+    return True
 
-            output_image = Image.alpha_composite(output_image, overlay)
-            draw = ImageDraw.Draw(output_image)
+# Worker threads for network fetches that can overlap with image work
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+# Main loop to keep updating the image
+while True:
+    try:
+        now_playing = fetch_now_playing_with_retries(max_retries=5, retry_delay=10)
+        if now_playing is NOW_PLAYING_UNCHANGED:
+            debug_print("Now-playing data unchanged, skipping image update.")
+            time.sleep(10)
+            continue
+
+        songname, artistname, album_art_url = now_playing
+
+        if songname and (songname != last_songname or not last_songname):
+            debug_print(f"Song has changed or is initial run: {last_songname} -> {songname}")
+
+            # Start fetching album art (background + thumbnail, cached by URL) in the
+            # background while the text layout is worked out
+            art_future = None
+            cached_background = BG_CACHE.get(album_art_url)
+            if album_art_url and cached_background is None:
+                art_future = executor.submit(fetch_album_art_layers, album_art_url)
 
             # --- Text Uniform Font Size Calculation and Positioning ---
 
@@ -362,7 +448,7 @@ while True:
 
             # 2. Find the minimum size and create a new, final uniform font object
             final_size = min(artist_font_adjusted.size, title_font_adjusted.size)
-            final_font = ImageFont.truetype(base_font.path, final_size)
+            final_font = _font(base_font.path, final_size)
 
             # Truncate text using the final uniform font size
             artistname_display = artistname.upper() # Uppercase for "bold" effect
@@ -380,6 +466,77 @@ while True:
             artistname_position = (text_x, TEXT_BG_Y + artist_y_offset)
             songname_position = (text_x, TEXT_BG_Y + title_y_offset)
 
+            # Reuse the composited background + thumbnail if this art was rendered before
+            if cached_background is not None:
+                debug_print("Reusing cached background for this album art.")
+                output_image = cached_background.copy()
+                draw = ImageDraw.Draw(output_image)
+            else:
+                # Create a blank image with the target dimensions (320x240)
+                output_image = Image.new("RGBA", (TARGET_WIDTH, TARGET_HEIGHT), (0, 0, 0, 255))
+                draw = ImageDraw.Draw(output_image)
+
+                # --- Album Art and Fallback Logic ---
+
+                # Wait for the album art fetch started above
+                art_layers = None
+                if art_future is not None:
+                    art_layers = art_future.result()
+                art_fetched = art_layers is not None
+
+                # Use fallback logo if album art is not found
+                if art_layers is None and FALLBACK_ART_LAYERS is not None:
+                    debug_print("Using fallback logo as album art.")
+                    art_layers = FALLBACK_ART_LAYERS
+                elif art_layers is None:
+                    debug_print("No album art and no fallback logo available.")
+
+                # --- Background: Blurred Album Art/Fallback Logo ---
+                if art_layers:
+                    resized_art, album_art_thumbnail = art_layers
+                    blurred_background = blur_background(resized_art)
+                    output_image.paste(blurred_background, (0, 0))
+                else:
+                    debug_print("Could not create blurred background (using black default).")
+
+                # --- Album Art Thumbnail and Border (Position based on text bar) ---
+                album_art_thumbnail_size = ALBUM_ART_THUMBNAIL_SIZE
+                border_size = 2
+
+                # Position calculations
+                available_top_space = TEXT_BG_Y - 0
+                thumb_x = (TARGET_WIDTH - album_art_thumbnail_size) // 2
+                thumb_y = (available_top_space - album_art_thumbnail_size) // 2
+
+                # Draw Border (a grey rectangle)
+                border_rect = (
+                    thumb_x - border_size,
+                    thumb_y - border_size,
+                    thumb_x + album_art_thumbnail_size + border_size,
+                    thumb_y + album_art_thumbnail_size + border_size
+                )
+                draw.rectangle(border_rect, fill=(55, 56, 52, 180))
+
+                if art_layers: # Use the same image (either fetched or fallback) for the thumbnail
+                    if album_art_thumbnail.mode == "RGBA":
+                        output_image.paste(album_art_thumbnail, (thumb_x, thumb_y), album_art_thumbnail)
+                    else:
+                        output_image.paste(album_art_thumbnail, (thumb_x, thumb_y))
+                else:
+                    debug_print("Could not create album art thumbnail (only border visible).")
+
+                # Remember the background + thumbnail (no text bar) for this art URL; a failed
+                # fetch isn't cached so it's retried next time
+                if art_fetched or not album_art_url:
+                    if len(BG_CACHE) >= BG_CACHE_SIZE:
+                        BG_CACHE.pop(next(iter(BG_CACHE))) # Evict the oldest entry
+                    BG_CACHE[album_art_url] = output_image.copy()
+
+            # --- Text Overlay and Logo Placement ---
+
+            # The bar + logo layer never changes; blend it in place over the bottom band only
+            output_image.alpha_composite(BAR_LAYER, (0, TEXT_BG_Y))
+
             # Draw Text with stroke/shadow - Use anchor="lm" (Left Middle) for left alignment
             stroke_width = 1
             stroke_fill = (0, 0, 0, 150)
@@ -396,8 +553,10 @@ while True:
                 output_image = output_image.convert("RGB")
 
             # Save image and update last song
-            output_image.save(output_image_path)
-            debug_print(f"Image saved to {output_image_path}")
+            if save_output_image(output_image, output_image_path):
+                debug_print(f"Image saved to {output_image_path}")
+            else:
+                debug_print("Image unchanged, skipping save.")
             last_songname = songname
 
         else:
@@ -408,4 +567,7 @@ while True:
 
     except Exception as e:
         debug_print(f"Error in main loop: {e}")
+        # Forget the cached response so the next poll rebuilds the image
+        last_etag = None
+        last_response_hash = None
         time.sleep(10)
\ No newline at end of file